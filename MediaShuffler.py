@@ -1,386 +1,557 @@
-# main.py
-import os
-import re
-import logging
-import yaml
-import sqlite3
-import asyncio
-from pathlib import Path
-from datetime import datetime
-from telegram import Bot
-from telegram.ext import Application, CommandHandler
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
-from contextlib import contextmanager
-
-# 配置日志
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
-
-# 加载配置
-with open('config.yaml', encoding='utf-8') as f:
-    full_config = yaml.safe_load(f)
-    config = full_config['bot']
-
-# 初始化数据库
-DB_PATH = 'media.db'
-conn_pool = sqlite3.connect(DB_PATH, check_same_thread=False)
-
-@contextmanager
-def get_db():
-    try:
-        cursor = conn_pool.cursor()
-        yield cursor
-    finally:
-        conn_pool.commit()
-        cursor.close()
-
-with get_db() as c:
-    c.execute('''CREATE TABLE IF NOT EXISTS media (
-             id INTEGER PRIMARY KEY,
-             path TEXT UNIQUE,
-             created_at DATETIME,
-             is_deleted BOOLEAN DEFAULT 0)''')
-             
-with get_db() as c:
-    c.execute('''CREATE TABLE IF NOT EXISTS sent_media (
-             media_id INTEGER,
-             sent_at DATETIME)''')
-             
-with get_db() as c:
-    c.execute('''CREATE TRIGGER IF NOT EXISTS keep_1000_records
-             AFTER INSERT ON sent_media
-             BEGIN
-                 DELETE FROM sent_media 
-                 WHERE rowid IN (
-                     SELECT rowid FROM sent_media 
-                     ORDER BY sent_at DESC 
-                     LIMIT -1 OFFSET 1000
-                 );
-             END;''')
-conn_pool.commit()
-
-class ConfigValidator:
-    @staticmethod
-    def validate():
-        try:
-            datetime.strptime(config['daily_scan_time'], "%H:%M")
-        except ValueError:
-            logger.error("Invalid daily_scan_time format, should be HH:MM")
-            exit(1)
-
-        os_type = 'win' if os.name == 'nt' else 'linux'
-        if not Path(config['scan_dir'][os_type]).exists():
-            logger.error(f"Scan directory not exists: {config['scan_dir'][os_type]}")
-            exit(1)
-
-ConfigValidator.validate()
-
-class MediaScanner:
-    def __init__(self):
-        os_type = 'win' if os.name == 'nt' else 'linux'
-        self.scan_dir = Path(config['scan_dir'][os_type])
-        self.blacklist = config['blacklist']
-        self.valid_ext = {'.jpg', '.png', '.gif', '.webp', '.mp4'}
-        self.sent_suffix = "_Sent"
-        
-    def cleanup_sent_files(self):     
-        logger.info("Starting sent files cleanup...")
-        renamed_count = 0
-        
-        with get_db() as c:
-            c.execute('''SELECT m.path 
-                    FROM media m
-                    JOIN sent_media s ON m.id = s.media_id''')
-            sent_files = [row[0] for row in c.fetchall()]
-        
-            for rel_path in sent_files:
-                original_path = self.scan_dir / rel_path
-                if not original_path.exists():
-                    continue
-            
-                new_name = f"{original_path.stem}{self.sent_suffix}{original_path.suffix}"
-                new_path = original_path.with_name(new_name)
-            
-                try:
-                    original_path.rename(new_path)
-                    renamed_count += 1
-                except Exception as e:
-                    logger.error(f"重命名失败：{original_path} → {new_path}，错误：{str(e)}")
-        
-            c.execute('''DELETE FROM sent_media''')
-            logger.info(f"清理完成，重命名文件数：{renamed_count}，删除数据库记录数：{c.rowcount}")
-        conn_pool.commit()
-
-    def scan_files(self):
-        self._perform_scan()
-        self.cleanup_sent_files()
-
-    def _perform_scan(self):
-        logger.info("Starting media scan...")
-        current_files = set()
-
-        for file_path in self.scan_dir.rglob('*'):
-            if self._is_valid_file(file_path):
-                rel_path = str(file_path.relative_to(self.scan_dir))
-                current_files.add(rel_path)
-
-        self._update_database(current_files)
-        logger.info(f"扫描完成，总文件数：{len(current_files)}")
-
-    def _is_valid_file(self, path):
-        return (path.suffix.lower() in self.valid_ext and
-                not any(b in path.name for b in self.blacklist) and
-                path.is_file())
-
-    def _update_database(self, current_files):
-        with get_db() as c:
-            c.execute("SELECT path FROM media WHERE is_deleted=0")
-            db_files = {row[0] for row in c.fetchall()}
-
-            for new_file in current_files - db_files:
-                c.execute("INSERT INTO media (path, created_at) VALUES (?, ?)",
-                     (new_file, datetime.now()))
-
-            for deleted in db_files - current_files:
-                c.execute("UPDATE media SET is_deleted=1 WHERE path=?", (deleted,))
-        conn_pool.commit()
-
-class BotCommands:
-    def __init__(self, app, scanner):
-        self.app = app
-        self.scanner = scanner
-        app.add_handler(CommandHandler("start", self.start))
-        app.add_handler(CommandHandler("set", self.send_media))
-        app.add_handler(CommandHandler("redb", self.rescan))
-
-    async def start(self, update, context):
-        if not self._is_admin(update):
-            return
-        await update.message.reply_text("✅ Bot正在工作中……")
-
-    async def send_media(self, update, context, manual=True):
-        if manual and not self._is_admin(update):
-            return
-
-        media = self._get_random_media()
-        await update.message.reply_text("✅ 已发送")
-        if not media:
-            logger.warning("没有找到媒体文件")
-            return
-
-        success = await self._send_to_channel(media)
-        if success:
-            self._update_sent_records(media[0])
-            logger.info(f"Sent media: {media[1]}")
-
-    async def rescan(self, update, context):
-        if not self._is_admin(update):
-            return
-        self.scanner.scan_files()
-        await update.message.reply_text("✅ 数据库已刷新")
-
-    def _is_admin(self, update):
-        return update.effective_user.id in config['admin_ids']
-
-    def _get_random_media(self):
-        with get_db() as c:
-            c.execute('''SELECT m.id, m.path 
-                    FROM media m
-                    LEFT JOIN sent_media s ON m.id = s.media_id
-                    WHERE m.is_deleted=0 AND s.media_id IS NULL
-                    ORDER BY RANDOM() 
-                    LIMIT 1''')
-            return c.fetchone()
-
-    async def _send_to_channel(self, media):
-        full_path = self.scanner.scan_dir / media[1]
-        try:
-            with open(full_path, 'rb') as f:
-                if media[1].endswith('.mp4'):
-                    await self.app.bot.send_video(config['channel_id'], f)
-                else:
-                    await self.app.bot.send_photo(config['channel_id'], f)
-            return True
-        except Exception as e:
-            logger.error(f"Failed to send media: {str(e)}")
-            return False
-
-    def _update_sent_records(self, media_id):
-        with get_db() as c:
-            c.execute("INSERT INTO sent_media VALUES (?, ?)", 
-                    (media_id, datetime.now()))
-        conn_pool.commit()
-
-class SchedulerManager:
-    def __init__(self, app, scanner, bot_commands):
-        self.scheduler = BackgroundScheduler()
-        self.app = app
-        self.scanner = scanner
-        self.bot_commands = bot_commands
-        self.loop = None
-        self._setup_jobs()
-
-    def _setup_jobs(self):
-        self._add_daily_maintenance_job()
-        self._add_media_send_job()
-        self._add_text_schedules()
-
-    def _add_daily_maintenance_job(self):
-        scan_time = config['daily_scan_time']
-        hour, minute = map(int, scan_time.split(':'))
-        trigger = CronTrigger(hour=hour, minute=minute, timezone='Asia/Shanghai')
-        self.scheduler.add_job(
-            self._execute_daily_tasks,
-            trigger=trigger,
-            name="daily_maintenance",
-            max_instances=1
-        )
-
-    def _execute_daily_tasks(self):
-        if self.loop and self.loop.is_running():
-            future = asyncio.run_coroutine_threadsafe(
-                self._async_daily_tasks(), 
-                self.loop
-            )
-            try:
-                future.result(timeout=300)
-            except asyncio.TimeoutError:
-                logger.error("每日任务执行超时")
-
-    async def _async_daily_tasks(self):
-        logger.info("开始每日文件扫描...")
-        self.scanner.scan_files()
-        logger.info("每日维护任务完成")
-
-    def _add_media_send_job(self):
-        interval = config['interval']
-        self.scheduler.add_job(
-            self._wrap_send_media,
-            trigger='interval',
-            minutes=interval,
-            name="random_media_send",
-            max_instances=2
-        )
-
-    def _wrap_send_media(self):
-        if self.loop and self.loop.is_running():
-            asyncio.run_coroutine_threadsafe(
-                self.bot_commands.send_media(None, None, manual=False),
-                self.loop
-            )
-
-    def _add_text_schedules(self):
-        for schedule in config['text_schedules']:
-            self._add_single_text_job(schedule)
-
-    def _add_single_text_job(self, schedule_config):
-        try:
-            trigger = self._parse_schedule(schedule_config['schedule'])
-            content = schedule_config['content'].replace('\\n', '\n')
-            self.scheduler.add_job(
-                self._wrap_send_text,
-                trigger=trigger,
-                kwargs={'content': content},
-                name=f"text_schedule_{schedule_config['name']}",
-                max_instances=1
-            )
-        except Exception as e:
-            logger.error(f"定时任务配置错误: {schedule_config['name']} - {str(e)}")
-
-    def _parse_schedule(self, schedule_str):
-        """支持多种定时格式的解析方法"""
-        # 格式1: day HH:MM (每日任务)
-        if schedule_str.startswith('day '):
-            try:
-                _, time_part = schedule_str.split(' ', 1)
-                hour, minute = map(int, time_part.split(':'))
-                return CronTrigger(
-                    hour=hour,
-                    minute=minute,
-                    timezone='Asia/Shanghai'
-                )
-            except ValueError:
-                raise ValueError(f"Invalid day format: {schedule_str}")
-
-        # 格式2: week <星期数> HH:MM (每周任务)
-        elif schedule_str.startswith('week '):
-            parts = schedule_str.split()
-            if len(parts) != 3:
-                raise ValueError(f"Invalid week format: {schedule_str}")
-            
-            day_map = {
-                '0': 'mon', '1': 'tue', '2': 'wed', '3': 'thu',
-                '4': 'fri', '5': 'sat', '6': 'sun'
-            }
-            day = parts[1]
-            hour, minute = map(int, parts[2].split(':'))
-            
-            return CronTrigger(
-                day_of_week=day_map.get(day, day),
-                hour=hour,
-                minute=minute,
-                timezone='Asia/Shanghai'
-            )
-
-        # 格式3: cron表达式
-        elif schedule_str.startswith('cron '):
-            cron_exp = schedule_str.split(' ', 1)[1]
-            return CronTrigger.from_crontab(cron_exp, timezone='Asia/Shanghai')
-
-        else:
-            raise ValueError(f"Unsupported schedule format: {schedule_str}")
-
-    def _wrap_send_text(self, content):
-        if self.loop is not None:
-            asyncio.run_coroutine_threadsafe(
-                self._send_text_message(content),
-                self.loop
-            )
-
-    async def _send_text_message(self, content):
-        try:
-            await self.app.bot.send_message(
-                chat_id=config['channel_id'],
-                text=content,
-                parse_mode='MarkdownV2'
-            )
-            logger.info(f"定时文本已发送：{content[:50]}...")
-        except Exception as e:
-            logger.error(f"文本发送失败：{str(e)}")
-
-    def start(self):
-        """安全启动调度器"""
-        try:
-            self.loop = asyncio.get_event_loop()
-        except RuntimeError as e:
-            if "no current event loop" in str(e):
-                self.loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(self.loop)
-            else:
-                raise
-        
-        self.scheduler.start()
-
-    def shutdown(self):
-        self.scheduler.shutdown(wait=False)
-
-def main():
-    application = Application.builder().token(config['token']).build()
-    scanner = MediaScanner()
-    scanner.scan_files()
-    bot_commands = BotCommands(application, scanner)
-    scheduler = SchedulerManager(application, scanner, bot_commands)
-    
-    try:
-        scheduler.start()
-        application.run_polling()
-    finally:
-        scheduler.shutdown()
-        conn_pool.close()
-
-if __name__ == '__main__':
+# main.py
+import os
+import re
+import time
+import random
+import logging
+import yaml
+import sqlite3
+import aiosqlite
+import asyncio
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from datetime import datetime
+from dataclasses import dataclass
+from telegram import Bot
+from telegram.ext import Application, CommandHandler
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.cron import CronTrigger
+from contextlib import contextmanager
+
+# 配置日志
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# 加载配置：只在启动时读一次，热路径上全部走属性访问
+@dataclass(slots=True, frozen=True)
+class Cfg:
+    token: str
+    channel_id: int
+    admin_ids: frozenset
+    scan_dir: str
+    blacklist: tuple
+    interval: int
+    daily_scan_time: str
+    text_schedules: tuple
+
+with open('config.yaml', encoding='utf-8') as f:
+    _raw = yaml.safe_load(f)['bot']
+
+CFG = Cfg(
+    token=_raw['token'],
+    channel_id=_raw['channel_id'],
+    admin_ids=frozenset(_raw['admin_ids']),
+    scan_dir=_raw['scan_dir']['win' if os.name == 'nt' else 'linux'],
+    blacklist=tuple(_raw['blacklist']),
+    interval=_raw['interval'],
+    daily_scan_time=_raw['daily_scan_time'],
+    text_schedules=tuple(_raw['text_schedules']),
+)
+
+VALID_EXT = frozenset({'.jpg', '.png', '.gif', '.webp', '.mp4'})
+
+# 初始化数据库
+DB_PATH = 'media.db'
+conn_pool = sqlite3.connect(DB_PATH, check_same_thread=False)
+conn_pool.executescript('''PRAGMA journal_mode=WAL;
+                        PRAGMA synchronous=NORMAL;
+                        PRAGMA temp_store=MEMORY;
+                        PRAGMA cache_size=-64000;
+                        PRAGMA mmap_size=268435456;''')
+
+_aio_conn = None
+_aio_conn_lock = asyncio.Lock()
+
+async def get_aio_db():
+    """懒加载的 aiosqlite 连接，供 bot 协程内使用，避免阻塞事件循环"""
+    global _aio_conn
+    if _aio_conn is None:
+        # 加锁防止定时发送和手动命令并发初始化，开出两条连接泄漏一条
+        async with _aio_conn_lock:
+            if _aio_conn is None:
+                conn = await aiosqlite.connect(DB_PATH)
+                await conn.executescript('''PRAGMA journal_mode=WAL;
+                                         PRAGMA synchronous=NORMAL;
+                                         PRAGMA temp_store=MEMORY;
+                                         PRAGMA cache_size=-64000;
+                                         PRAGMA mmap_size=268435456;''')
+                _aio_conn = conn
+    return _aio_conn
+
+async def close_aio_db(_app=None):
+    """随 Application 停机关闭 aiosqlite 连接（post_shutdown 回调）"""
+    global _aio_conn
+    async with _aio_conn_lock:
+        if _aio_conn is not None:
+            await _aio_conn.close()
+            _aio_conn = None
+
+@contextmanager
+def get_db_write():
+    """写游标，正常退出时提交一次，异常时回滚，避免半截事务被后续提交带上"""
+    cursor = conn_pool.cursor()
+    try:
+        yield cursor
+        conn_pool.commit()
+    except Exception:
+        conn_pool.rollback()
+        raise
+    finally:
+        cursor.close()
+
+with get_db_write() as c:
+    c.execute('''CREATE TABLE IF NOT EXISTS media (
+             id INTEGER PRIMARY KEY,
+             path TEXT UNIQUE,
+             created_at DATETIME,
+             is_deleted BOOLEAN DEFAULT 0)''')
+             
+with get_db_write() as c:
+    c.execute('''CREATE TABLE IF NOT EXISTS sent_media (
+             media_id INTEGER,
+             sent_at DATETIME)''')
+             
+# 旧版在每次插入时用触发器整表排序修剪，现改为插入路径上按需修剪
+with get_db_write() as c:
+    c.execute('DROP TRIGGER IF EXISTS keep_1000_records')
+
+with get_db_write() as c:
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_sent_media_id
+             ON sent_media(media_id)''')
+
+with get_db_write() as c:
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_sent_media_sent_at
+             ON sent_media(sent_at DESC)''')
+
+with get_db_write() as c:
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_media_active
+             ON media(is_deleted) WHERE is_deleted=0''')
+
+class ConfigValidator:
+    @staticmethod
+    def validate():
+        try:
+            datetime.strptime(CFG.daily_scan_time, "%H:%M")
+        except ValueError:
+            logger.error("Invalid daily_scan_time format, should be HH:MM")
+            exit(1)
+
+        if not Path(CFG.scan_dir).exists():
+            logger.error(f"Scan directory not exists: {CFG.scan_dir}")
+            exit(1)
+
+ConfigValidator.validate()
+
+class MediaScanner:
+    def __init__(self):
+        self.scan_dir = Path(CFG.scan_dir)
+        self.blacklist = CFG.blacklist
+        # 空黑名单不能编译：空模式匹配一切，会把整个库判为无效
+        self._black_re = (re.compile('|'.join(map(re.escape, self.blacklist)))
+                          if self.blacklist else None)
+        self.video_exts = ('.mp4',)
+        self.sent_suffix = "_Sent"
+        
+    def cleanup_sent_files(self):
+        logger.info("Starting sent files cleanup...")
+        renamed_count = 0
+        scan_root = str(self.scan_dir)
+
+        with get_db_write() as c:
+            c.execute('''SELECT m.path
+                    FROM media m
+                    JOIN sent_media s ON m.id = s.media_id''')
+            sent_files = [row[0] for row in c.fetchall()]
+
+            for rel_path in sent_files:
+                original_path = os.path.join(scan_root, rel_path)
+                root, ext = os.path.splitext(original_path)
+                new_path = f"{root}{self.sent_suffix}{ext}"
+
+                try:
+                    # rename 本身对缺失文件会直接失败，无需先 stat 一次
+                    os.replace(original_path, new_path)
+                    renamed_count += 1
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    logger.error(f"重命名失败：{original_path} → {new_path}，错误：{str(e)}")
+
+            c.execute('''DELETE FROM sent_media''')
+            logger.info(f"清理完成，重命名文件数：{renamed_count}，删除数据库记录数：{c.rowcount}")
+
+    def scan_files(self):
+        self._perform_scan()
+        self.cleanup_sent_files()
+
+    def _perform_scan(self):
+        logger.info("Starting media scan...")
+        scan_root = str(self.scan_dir)
+        current_files = self._scan_parallel(scan_root)
+        self._update_database(current_files)
+        logger.info(f"扫描完成，总文件数：{len(current_files)}")
+
+    def _scan_parallel(self, scan_root, max_workers=8):
+        """多线程深度优先遍历：scandir/stat 期间释放 GIL，
+        对网络盘等高延迟存储可并行读取各子目录"""
+        pending = queue.Queue()
+        pending.put(scan_root)
+        matched = set()
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                dir_path = pending.get()
+                if dir_path is None:
+                    break
+                # task_done 必须进 finally：任何目录读失败若漏计数，
+                # pending.join() 会永远挂起，拖死整次扫描
+                try:
+                    local = []
+                    with os.scandir(dir_path) as it:
+                        for entry in it:
+                            if entry.is_symlink():
+                                continue
+                            if entry.is_file(follow_symlinks=False):
+                                if self._is_valid_entry(entry):
+                                    local.append(
+                                        os.path.relpath(entry.path, scan_root))
+                            elif entry.is_dir(follow_symlinks=False):
+                                pending.put(entry.path)
+                    if local:
+                        with lock:
+                            matched.update(local)
+                except PermissionError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"扫描目录失败：{dir_path}，错误：{str(e)}")
+                finally:
+                    pending.task_done()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for _ in range(max_workers):
+                pool.submit(worker)
+            pending.join()
+            for _ in range(max_workers):
+                pending.put(None)
+
+        return matched
+
+    def _is_valid_entry(self, entry):
+        name = entry.name
+        dot = name.rfind('.')
+        if dot < 0:
+            return False
+        if name[dot:].lower() not in VALID_EXT:
+            return False
+        return self._black_re is None or not self._black_re.search(name)
+
+    def _update_database(self, current_files):
+        with get_db_write() as c:
+            # IF NOT EXISTS + 先清空：上次扫描中途失败残留的临时表不会再卡死后续扫描
+            c.execute('''CREATE TEMP TABLE IF NOT EXISTS
+                    scan_paths (path TEXT PRIMARY KEY)''')
+            c.execute("DELETE FROM scan_paths")
+            c.executemany("INSERT OR IGNORE INTO scan_paths VALUES (?)",
+                     ((path,) for path in current_files))
+
+            # 差集交给 SQL 计算，省掉把库内路径拉回 Python 再做 set 运算；
+            # 曾标记删除后又出现的文件恢复为有效，而不是撞 UNIQUE 约束
+            c.execute('''UPDATE media SET is_deleted=0
+                    WHERE is_deleted=1
+                    AND path IN (SELECT path FROM scan_paths)''')
+            c.execute('''INSERT INTO media (path, created_at)
+                    SELECT path, ? FROM scan_paths
+                    WHERE path NOT IN (SELECT path FROM media)''',
+                    (datetime.now(),))
+            c.execute('''UPDATE media SET is_deleted=1
+                    WHERE is_deleted=0
+                    AND path NOT IN (SELECT path FROM scan_paths)''')
+            c.execute("DELETE FROM scan_paths")
+        conn_pool.execute("ANALYZE")
+
+class BotCommands:
+    def __init__(self, app, scanner):
+        self.app = app
+        self.scanner = scanner
+        self._max_id_cache = None
+        self._max_id_cached_at = 0.0
+        self._send_video = app.bot.send_video
+        self._send_photo = app.bot.send_photo
+        app.add_handler(CommandHandler("start", self.start))
+        app.add_handler(CommandHandler("set", self.send_media))
+        app.add_handler(CommandHandler("redb", self.rescan))
+
+    async def start(self, update, context):
+        if not self._is_admin(update):
+            return
+        await update.message.reply_text("✅ Bot正在工作中……")
+
+    async def send_media(self, update, context, manual=True):
+        if manual and not self._is_admin(update):
+            return
+
+        media = await self._get_random_media()
+        await update.message.reply_text("✅ 已发送")
+        if not media:
+            logger.warning("没有找到媒体文件")
+            return
+
+        success = await self._send_to_channel(media)
+        if success:
+            await self._update_sent_records(media[0])
+            logger.info(f"Sent media: {media[1]}")
+
+    async def rescan(self, update, context):
+        if not self._is_admin(update):
+            return
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.scanner.scan_files)
+        await update.message.reply_text("✅ 数据库已刷新")
+
+    def _is_admin(self, update):
+        return update.effective_user.id in CFG.admin_ids
+
+    async def _get_random_media(self):
+        conn = await get_aio_db()
+        max_id = await self._get_max_media_id(conn)
+        if not max_id:
+            return None
+
+        # 随机抽取 rowid 再探测，避免 ORDER BY RANDOM() 对全表排序
+        for _ in range(10):
+            rid = random.randint(1, max_id)
+            async with conn.execute('''SELECT m.id, m.path
+                    FROM media m
+                    LEFT JOIN sent_media s ON m.id = s.media_id
+                    WHERE m.id>=? AND m.is_deleted=0 AND s.media_id IS NULL
+                    ORDER BY m.id
+                    LIMIT 1''', (rid,)) as cur:
+                row = await cur.fetchone()
+            if row:
+                return row
+
+        # 多次落空说明候选稀疏，回退到全表随机保证能取到
+        async with conn.execute('''SELECT m.id, m.path
+                FROM media m
+                LEFT JOIN sent_media s ON m.id = s.media_id
+                WHERE m.is_deleted=0 AND s.media_id IS NULL
+                ORDER BY RANDOM()
+                LIMIT 1''') as cur:
+            return await cur.fetchone()
+
+    async def _get_max_media_id(self, conn):
+        now = time.monotonic()
+        if self._max_id_cache is None or now - self._max_id_cached_at > 60:
+            async with conn.execute(
+                    "SELECT MAX(id) FROM media WHERE is_deleted=0") as cur:
+                self._max_id_cache = (await cur.fetchone())[0]
+            self._max_id_cached_at = now
+        return self._max_id_cache
+
+    async def _send_to_channel(self, media):
+        full_path = os.path.join(str(self.scanner.scan_dir), media[1])
+        try:
+            # PTB 收到路径时仍会在事件循环里同步读整个文件，
+            # 所以读文件放到线程池，循环只拿到现成的 bytes
+            data = await asyncio.get_running_loop().run_in_executor(
+                None, Path(full_path).read_bytes)
+            if media[1].endswith(self.scanner.video_exts):
+                await self._send_video(CFG.channel_id, data)
+            else:
+                await self._send_photo(CFG.channel_id, data)
+            return True
+        except Exception as e:
+            logger.error(f"Failed to send media: {str(e)}")
+            return False
+
+    async def _update_sent_records(self, media_id):
+        conn = await get_aio_db()
+        await conn.execute("INSERT INTO sent_media VALUES (?, ?)",
+                (media_id, datetime.now()))
+
+        # 超过 1000 条才修剪一次，代价从每次插入降到每千次插入
+        async with conn.execute("SELECT COUNT(*) FROM sent_media") as cur:
+            count = (await cur.fetchone())[0]
+        if count > 1000:
+            await conn.execute('''DELETE FROM sent_media
+                    WHERE sent_at < (SELECT sent_at FROM sent_media
+                                     ORDER BY sent_at DESC
+                                     LIMIT 1 OFFSET 1000)''')
+        await conn.commit()
+
+WEEK_DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+class SchedulerManager:
+    _SCHED_RE = re.compile(r'^(day|week|cron)\s+(.*)$')
+
+    def __init__(self, app, scanner, bot_commands, loop):
+        self.scheduler = BackgroundScheduler()
+        self.app = app
+        self.scanner = scanner
+        self.bot_commands = bot_commands
+        self._loop = loop
+        self._sched_handlers = {
+            'day': self._parse_day,
+            'week': self._parse_week,
+            'cron': self._parse_cron,
+        }
+        self._setup_jobs()
+
+    def _setup_jobs(self):
+        self._add_daily_maintenance_job()
+        self._add_media_send_job()
+        self._add_text_schedules()
+
+    def _add_daily_maintenance_job(self):
+        scan_time = CFG.daily_scan_time
+        hour, minute = map(int, scan_time.split(':'))
+        trigger = CronTrigger(hour=hour, minute=minute, timezone='Asia/Shanghai')
+        self.scheduler.add_job(
+            self._execute_daily_tasks,
+            trigger=trigger,
+            name="daily_maintenance",
+            max_instances=1
+        )
+
+    def _execute_daily_tasks(self):
+        future = asyncio.run_coroutine_threadsafe(
+            self._async_daily_tasks(),
+            self._loop
+        )
+        try:
+            future.result(timeout=300)
+        except asyncio.TimeoutError:
+            logger.error("每日任务执行超时")
+
+    async def _async_daily_tasks(self):
+        logger.info("开始每日文件扫描...")
+        # 扫描是同步阻塞操作，放到线程池跑，期间事件循环继续响应命令
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.scanner.scan_files)
+        logger.info("每日维护任务完成")
+
+    def _add_media_send_job(self):
+        interval = CFG.interval
+        self.scheduler.add_job(
+            self._wrap_send_media,
+            trigger='interval',
+            minutes=interval,
+            name="random_media_send",
+            max_instances=2
+        )
+
+    def _wrap_send_media(self):
+        asyncio.run_coroutine_threadsafe(
+            self.bot_commands.send_media(None, None, manual=False),
+            self._loop
+        )
+
+    def _add_text_schedules(self):
+        for schedule in CFG.text_schedules:
+            self._add_single_text_job(schedule)
+
+    def _add_single_text_job(self, schedule_config):
+        try:
+            trigger = self._parse_schedule(schedule_config['schedule'])
+            content = schedule_config['content'].replace('\\n', '\n')
+            self.scheduler.add_job(
+                self._wrap_send_text,
+                trigger=trigger,
+                kwargs={'content': content},
+                name=f"text_schedule_{schedule_config['name']}",
+                max_instances=1
+            )
+        except Exception as e:
+            logger.error(f"定时任务配置错误: {schedule_config['name']} - {str(e)}")
+
+    def _parse_schedule(self, schedule_str):
+        """支持多种定时格式的解析方法，按前缀分发到对应的解析器"""
+        m = self._SCHED_RE.match(schedule_str)
+        if not m:
+            raise ValueError(f"Unsupported schedule format: {schedule_str}")
+        return self._sched_handlers[m.group(1)](m.group(2))
+
+    # 格式1: day HH:MM (每日任务)
+    def _parse_day(self, spec):
+        try:
+            hour, minute = map(int, spec.split(':'))
+        except ValueError:
+            raise ValueError(f"Invalid day format: day {spec}")
+        return CronTrigger(
+            hour=hour,
+            minute=minute,
+            timezone='Asia/Shanghai'
+        )
+
+    # 格式2: week <星期数> HH:MM (每周任务)
+    def _parse_week(self, spec):
+        parts = spec.split()
+        if len(parts) != 2:
+            raise ValueError(f"Invalid week format: week {spec}")
+
+        day = parts[0]
+        if day.isdigit():
+            day = WEEK_DAYS[int(day)]
+        hour, minute = map(int, parts[1].split(':'))
+
+        return CronTrigger(
+            day_of_week=day,
+            hour=hour,
+            minute=minute,
+            timezone='Asia/Shanghai'
+        )
+
+    # 格式3: cron表达式
+    def _parse_cron(self, spec):
+        return CronTrigger.from_crontab(spec, timezone='Asia/Shanghai')
+
+    def _wrap_send_text(self, content):
+        asyncio.run_coroutine_threadsafe(
+            self._send_text_message(content),
+            self._loop
+        )
+
+    async def _send_text_message(self, content):
+        try:
+            await self.app.bot.send_message(
+                chat_id=CFG.channel_id,
+                text=content,
+                parse_mode='MarkdownV2'
+            )
+            logger.info(f"定时文本已发送：{content[:50]}...")
+        except Exception as e:
+            logger.error(f"文本发送失败：{str(e)}")
+
+    def start(self):
+        self.scheduler.start()
+
+    def shutdown(self):
+        self.scheduler.shutdown(wait=False)
+
+def main():
+    application = (Application.builder()
+                   .token(CFG.token)
+                   .post_shutdown(close_aio_db)
+                   .build())
+    scanner = MediaScanner()
+    scanner.scan_files()
+    bot_commands = BotCommands(application, scanner)
+    # 事件循环在此取定一次并注入，调度器线程回调不再逐次探测
+    loop = asyncio.get_event_loop_policy().get_event_loop()
+    scheduler = SchedulerManager(application, scanner, bot_commands, loop)
+    
+    try:
+        scheduler.start()
+        application.run_polling()
+    finally:
+        scheduler.shutdown()
+        conn_pool.close()
+
+if __name__ == '__main__':
     main()
\ No newline at end of file